@@ -83,35 +83,81 @@ def find_roll_joints(parent_joint):
     roll_joints = [joint for joint in descendants if 'Roll' in joint.nodeName()]
     return roll_joints
 
-def calculate_distance(obj1, obj2):
-    """Calculate the distance between two objects in world space."""
-    pos1 = pm.xform(obj1, q=True, ws=True, t=True)
-    pos2 = pm.xform(obj2, q=True, ws=True, t=True)
-    return ((pos1[0] - pos2[0])**2 + 
-            (pos1[1] - pos2[1])**2 + 
-            (pos1[2] - pos2[2])**2) ** 0.5
-
-def sort_roll_joints_by_distance(roll_joints, forearm_joint):
-    """Sort roll joints based on their distance to the forearm joint."""
-    return sorted(roll_joints, key=lambda joint: calculate_distance(joint, forearm_joint))
-
-def generate_roll_fractions(num_joints, max_value=0.75, min_value=0.15):
-    step = (max_value - min_value) / (num_joints - 1)
-    fractions = [max_value - i * step for i in range(num_joints)]
-    return fractions
-
-def delete_nodes_containing(substring, node_type=None):
-    # Find all nodes of the specified type, or all nodes if no type is provided
-    if node_type:
-        nodes = pm.ls(type=node_type)
+def get_world_positions(nodes):
+    """World space positions of all nodes from a single xform query."""
+    flat = pm.xform(nodes, q=True, ws=True, t=True)
+    return [pm.datatypes.Vector(flat[i:i + 3]) for i in range(0, len(flat), 3)]
+
+def order_roll_joints_along_axis(roll_joints, positions, start, end):
+    """Order roll joints by their projection on the start -> end axis, fraction is that parameter."""
+    axis = end - start
+    length_sq = axis.dot(axis)
+    if length_sq == 0:
+        # Both ends on the same spot give no axis to project on, spread the rolls evenly instead
+        pm.warning("Roll segment has zero length, spreading {} roll joints evenly".format(len(roll_joints)))
+        return [(joint, float(i + 1) / (len(roll_joints) + 1)) for i, joint in enumerate(roll_joints)]
+    params = []
+    for joint, position in zip(roll_joints, positions):
+        # Offsets from the bone don't matter, only how far along it the joint sits
+        t = (position - start).dot(axis) / length_sq
+        params.append((joint, min(max(t, 0.0), 1.0)))
+    return sorted(params, key=lambda item: item[1])
+
+def reference_path(node):
+    # UUIDs of the reference nodes a node comes through, innermost first, empty for local nodes
+    if not pm.referenceQuery(node, isNodeReferenced=True):
+        return ''
+    path = []
+    ref_node = pm.referenceQuery(node, referenceNode=True)
+    while ref_node:
+        path.append(pm.ls(ref_node, uuid=True)[0])
+        ref_node = pm.referenceQuery(ref_node, referenceNode=True, parent=True)
+    return ','.join(path)
+
+def get_handle(node):
+    # Node UUID plus the reference path, the same handle the UI version stores, so both tools see each other's rigs
+    handle = pm.ls(node, uuid=True)[0]
+    path = reference_path(node)
+    if path:
+        handle += '/' + path
+    return handle
+
+def resolve_handle(handle):
+    uuid, _, path = handle.partition('/')
+    nodes = [node for node in pm.ls(uuid) if reference_path(node) == path]
+    return nodes[0] if nodes else None
+
+def tag_rig(joint, rig_group, nodes):
+    if not joint.hasAttr('armRig'):
+        pm.addAttr(joint, longName='armRig', dataType='string')
+    joint.armRig.set(get_handle(rig_group))
+    pm.addAttr(rig_group, longName='armRigNodes', dataType='string')
+    rig_group.armRigNodes.set(' '.join(get_handle(node) for node in nodes))
+
+def find_rig(joint):
+    # Rig group of the arm or None, read straight from the tag instead of searching by name
+    if joint.hasAttr('armRig') and joint.armRig.get():
+        return resolve_handle(joint.armRig.get())
+    # Rigs built before the tag existed are only known by their name
+    legacy = [group for group in pm.ls(joint.nodeName() + "_Rig", type='transform') if not group.hasAttr('armRigNodes')]
+    return legacy[0] if legacy else None
+
+def delete_rig(joint, chain):
+    rig_group = find_rig(joint)
+    if rig_group is None:
+        return False
+    if rig_group.hasAttr('armRigNodes'):
+        nodes = [resolve_handle(handle) for handle in rig_group.armRigNodes.get().split()]
+        joint.armRig.set('')
     else:
-        nodes = pm.ls()
-
-    # Iterate through the nodes and delete those that contain the substring
+        # Older rigs don't list their nodes, their roll multiplies hang off the chain's rotateX
+        nodes = [node for driver in chain for node in driver.rotateX.outputs(type='multiplyDivide')
+                 if node.nodeName().endswith('_rotationMult')] + [rig_group]
+    # Parents go first and take their children with them
     for node in nodes:
-        # Use the string name of the node for the substring check
-        if substring in str(node.name()):
+        if node is not None and node.exists():
             pm.delete(node)
+    return True
 
 def ask_rebuild_rig():
     # Create a confirm dialog
@@ -142,17 +188,14 @@ def create_arm_rig():
         pm.warning("Please select arm -> forearm -> hand")
         return
     # Make sure rig is not created yet
-    if pm.ls(selected[0].nodeName() + "_Rig", type='transform'):
+    if find_rig(selected[0]):
         pm.warning("Arm Rig already exists")
         if not ask_rebuild_rig():
             # Stop function if user cancels
             return
         else:
             # Delete existing rig
-            roll_joints = find_roll_joints(selected[0])
-            for joint in roll_joints:
-                delete_nodes_containing(joint.nodeName(),'multiplyDivide')
-            delete_nodes_containing(selected[0].nodeName() + "_Rig", 'transform')
+            delete_rig(selected[0], selected)
 
     # Store joints for ease of read =)
     arm = selected[0]
@@ -299,24 +342,28 @@ def create_arm_rig():
 
     #find roll joints
     roll_joints = find_roll_joints(forearm)
-    sorted_roll_joints = sort_roll_joints_by_distance(roll_joints, forearm)
-    num_of_joints = len(roll_joints)
-    frac = generate_roll_fractions(len(roll_joints), max_value=0.75,min_value= 0.25)[::-1]
+    # One query for forearm, hand and all rolls, then order and weight them along the bone
+    positions = get_world_positions([forearm, hand] + roll_joints)
+    ordered_roll_joints = order_roll_joints_along_axis(roll_joints, positions[2:], positions[0], positions[1])
+    mult_nodes = []
     
-    for i, joint in enumerate(sorted_roll_joints):
+    for joint, fraction in ordered_roll_joints:
         # Create a multiplyDivide node for each roll joint
-        mult_node = pm.createNode('multiplyDivide', name= joint + '_rotationMult')
+        mult_node = pm.createNode('multiplyDivide', name=joint.nodeName() + '_rotationMult')
+        mult_nodes.append(mult_node)
         # Set the multiply operation
         mult_node.operation.set(1)  # 1 = Multiply
         # Set the input2X to the fraction for this roll joint
-        mult_node.input2X.set(frac[i])
+        mult_node.input2X.set(fraction)
         # Connect the driver control's rotateX to the input1X of the multiplyDivide node
-        pm.connectAttr(hand + '.rotateX', mult_node + '.input1X')
+        pm.connectAttr(hand.rotateX, mult_node.input1X)
         # Connect the outputX of the multiplyDivide node to the joint's rotateX
-        pm.connectAttr(mult_node + '.outputX', joint + '.rotateX')
+        pm.connectAttr(mult_node.outputX, joint.rotateX)
     
     # fix rotation order of hand
     hand.rotateOrder.set(5)
+    # Tag the arm with the rig and the rig with everything outside it, so the next rebuild finds them by handle
+    tag_rig(arm, rig_group, [rig_group] + mult_nodes)
     pm.displayInfo("Arm rig was built successfully.")
 
 create_arm_rig()
\ No newline at end of file
@@ -2,6 +2,10 @@
 # github.com/flutesandyou/arm_rig
 # Usage: copy-paste to python script editor.
 
+import json
+import os
+import tempfile
+import time
 import pymel.core as pm
 
 class ArmRigUI(object):
@@ -11,6 +15,30 @@ class ArmRigUI(object):
         self.roll_joints = []
         self.arm_joints_field = None
         self.roll_joints_field = None
+        self.progress_bar = None
+        self.status_text = None
+        self.shared_shapes_checkbox = None
+        # Build queue, each rig is built in small units on Maya's idle queue
+        self.build_queue = []
+        self.current_build = None
+        self.build_running = False
+        self.cancel_requested = False
+        self.units_total = 0
+        self.units_done = 0
+        self.last_build_time = 0.0
+        self.build_stages = [
+            self.build_chain_layout,
+            self.build_fk_controls,
+            self.build_ik_chain,
+            self.build_pole_vector,
+            self.build_ik_control,
+            self.build_switch,
+            self.build_rig_groups,
+            self.build_ikfk_constraints,
+            self.build_roll_joints,
+            self.build_eval_lod,
+            self.register_rig,
+        ]
 
     def create_ui(self):
         if pm.window(self.window_name, exists=True):
@@ -21,7 +49,7 @@ class ArmRigUI(object):
                 pm.separator(height=5, style='none')
 
                 # Adding the usage note                            # Adding a frame to make the usage note more noticeable
-                pm.text(label="Step1: Please select joints in order Arm -> Forearm -> Hand",
+                pm.text(label="Step1: Please select joints in order Arm -> Forearm -> Hand, longer chains work too",
                         align='center', wordWrap=True, 
                         font="boldLabelFont")  # Bold font for visibility
                     
@@ -45,118 +73,266 @@ class ArmRigUI(object):
 
 
                 pm.separator(height=10, style='double')
+                # Instance one curve shape per style and size instead of a new one per rig
+                self.shared_shapes_checkbox = pm.checkBox(label="Share control shapes between rigs", value=False)
                 pm.button(label="Build Arm Rig", command=pm.Callback(self.create_arm_rig))
+                pm.button(label="Cancel Build", command=pm.Callback(self.cancel_build))
                 pm.button(label="Delete Arm Rig", command=pm.Callback(self.delete_arm_rig))
 
+                pm.separator(height=5, style='none')
+                self.progress_bar = pm.progressBar(maxValue=1, height=15)
+                self.status_text = pm.text(label="Idle", align='left')
+                # Builds run across idle ticks, so they can't be a single undo step
+                pm.text(label="Undo only steps back one build stage, use Delete Arm Rig to remove a whole rig",
+                        align='left', wordWrap=True)
+
         pm.showWindow()
 
     def select_arm_joints(self):
         selection = pm.ls(selection=True, type="joint")
 
-        if len(selection) != 3:
-            pm.warning("Please select arm -> forearm -> hand")
-            return
-        descendants = pm.listRelatives(selection[0], allDescendents=True, type="joint") or []
-        if selection[1] and selection[2] not in descendants:
-            pm.warning("Please select arm -> forearm -> hand")
+        if len(selection) < 3:
+            pm.warning("Please select at least 3 joints: arm -> forearm -> hand")
             return
+        # Every joint has to sit below the one selected before it
+        for parent, child in zip(selection, selection[1:]):
+            descendants = pm.listRelatives(parent, allDescendents=True, type="joint") or []
+            if child not in descendants:
+                pm.warning("Please select arm -> forearm -> hand")
+                return
 
-        if len(selection) == 3:
-            self.arm_joints = selection
-            joint_names = ", ".join([joint.name() for joint in selection])
-            self.arm_joints_field.setText(joint_names)
-        else:
-            pm.warning("Please select exactly 3 joints: arm -> forearm -> hand")
+        # Keep handles rather than PyNodes, they survive renames, references and file reloads
+        self.arm_joints = [get_handle(joint) for joint in selection]
+        joint_names = ", ".join([joint.name() for joint in selection])
+        self.arm_joints_field.setText(joint_names)
 
     def select_roll_joints(self):
         selection = pm.ls(selection=True, type="joint")
         if selection:
-            self.roll_joints = selection
+            roll_joints = [get_handle(joint) for joint in selection]
             # check if arm joints are part of roll joints lol!
-            if bool(set(self.roll_joints) & set(self.arm_joints)):
+            if bool(set(roll_joints) & set(self.arm_joints)):
                 pm.warning("Dont select arm joints as roll joints")
                 return
+            self.roll_joints = roll_joints
             joint_names = ", ".join([joint.name() for joint in selection])
             self.roll_joints_field.setText(joint_names)
         else:
+            self.roll_joints = []
             self.roll_joints_field.setText('')
 
 
     def create_arm_rig(self):
-        arm_joints = self.arm_joints
-        roll_joints = self.roll_joints
-
-        if len(arm_joints) != 3:
+        if len(self.arm_joints) < 3:
             pm.warning("Please fill all fields")
             return
-        
+
+        arm_joints = resolve_handles(self.arm_joints)
+        if arm_joints is None or resolve_handles(self.roll_joints) is None:
+            pm.warning("Selected joints no longer exist, please select them again")
+            return
+
+        # Make sure the same arm is not waiting in the queue already
+        queued = self.build_queue + ([self.current_build] if self.current_build else [])
+        if any(spec['arm_handles'][0] == self.arm_joints[0] for spec in queued):
+            pm.warning("Arm Rig for {} is already being built".format(arm_joints[0].nodeName()))
+            return
+
         # Make sure rig is not created yet
-        if pm.ls(arm_joints[0].nodeName() + "_Rig", type='transform'):
+        roll_segments = None
+        if find_rig(arm_joints[0]):
             pm.warning("Arm Rig already exists")
             if not self.ask_rebuild_rig():
                 # Stop function if user cancels
                 return
             else:
+                # Keep the roll ordering of the old rig if it was built from the same joints
+                roll_segments = read_rig_rolls(arm_joints[0], self.arm_joints, self.roll_joints)
                 # Delete existing rig
-                if roll_joints:
-                    for joint in roll_joints:
-                        delete_nodes_containing(joint.nodeName(),'multiplyDivide')
-                delete_nodes_containing(arm_joints[0].nodeName() + "_Rig", 'transform')
+                delete_rig(arm_joints[0], arm_joints)
 
-        # Store joints for ease of read =)
-        arm = arm_joints[0]
-        forearm = arm_joints[1]
-        hand = arm_joints[2]
+        # Snapshot the fields so the user can pick the next arm while this one builds
+        spec = {
+            'arm_handles': list(self.arm_joints),
+            # Name for messages, refreshed every unit in case the joint gets renamed
+            'arm_name': arm_joints[0].nodeName(),
+            'roll_handles': list(self.roll_joints),
+            'created': [],
+            'cached_roll_segments': roll_segments,
+            'shared_shapes': self.shared_shapes_checkbox.getValue() if self.shared_shapes_checkbox else False,
+            'stage': 0,
+            'start_time': None,
+        }
+        self.build_queue.append(spec)
+        self.units_total += len(self.build_stages)
+        self.update_progress()
 
-        pm.select(clear=True)
+        # Kick off the idle loop unless it is running already
+        if not self.build_running:
+            self.build_running = True
+            self.cancel_requested = False
+            self.schedule_build_unit()
+
+    def schedule_build_unit(self):
+        # Run the next unit when Maya has nothing else to do, so the UI stays responsive
+        pm.evalDeferred(self.run_build_unit, lowestPriority=True)
+
+    def run_build_unit(self):
+        if self.cancel_requested:
+            self.stop_build_queue("Build canceled.")
+            return
+
+        # Pick up the next rig from the queue
+        if self.current_build is None:
+            if not self.build_queue:
+                self.stop_build_queue("Done. Last rig took {:.2f}s".format(self.last_build_time))
+                return
+            self.current_build = self.build_queue.pop(0)
+            self.current_build['start_time'] = time.time()
+
+        spec = self.current_build
+        stage = self.build_stages[spec['stage']]
+        arm_name = spec['arm_name']
+
+        # Stages create nodes and Maya selects them, keep what the artist had selected instead
+        selection = [str(node) for node in pm.selected()]
+        failed = False
+        # Each stage is one undo step, the artist's own edits in between stay separate steps
+        pm.undoInfo(openChunk=True, chunkName="ArmRig_" + stage.__name__)
+        try:
+            # Re-resolve inputs every unit, the scene may have changed while we were idle
+            spec['arm_joints'] = resolve_handles(spec['arm_handles'])
+            spec['roll_joints'] = resolve_handles(spec['roll_handles'])
+            if spec['arm_joints'] is None or spec['roll_joints'] is None:
+                raise RuntimeError("input joints no longer exist")
+            arm_name = spec['arm_name'] = spec['arm_joints'][0].nodeName()
+            stage(spec)
+        except Exception as error:
+            pm.warning("Arm rig {} failed at {}: {}".format(arm_name, stage.__name__, error))
+            failed = True
+        finally:
+            restore_selection(selection)
+            pm.undoInfo(closeChunk=True)
+
+        if failed:
+            try:
+                self.rollback_build(spec)
+            finally:
+                # Whatever the rollback did, skip the rest of this rig and keep the queue going
+                self.units_done += len(self.build_stages) - spec['stage']
+                self.current_build = None
+                self.update_progress()
+                self.schedule_build_unit()
+            return
+
+        spec['stage'] += 1
+        self.units_done += 1
+
+        if spec['stage'] == len(self.build_stages):
+            self.last_build_time = time.time() - spec['start_time']
+            pm.displayInfo("Arm rig {} was built successfully in {:.2f}s.".format(arm_name, self.last_build_time))
+            self.current_build = None
 
-        # Initialize lists for IK and FK joints
-        ik_joints = []
-        fk_groups = []
-        fk_controls = []
+        self.update_progress("{}: {}".format(arm_name, stage.__name__))
+        self.schedule_build_unit()
+
+    def cancel_build(self):
+        if not self.build_running:
+            pm.warning("Nothing is being built")
+            return
+        # Picked up by the next scheduled unit, the unit in flight always finishes first
+        self.cancel_requested = True
+
+    def stop_build_queue(self, message):
+        try:
+            if self.current_build is not None:
+                self.rollback_build(self.current_build)
+        finally:
+            # Always reset, otherwise every later Build click would queue up and never run
+            self.current_build = None
+            self.build_queue = []
+            self.build_running = False
+            self.cancel_requested = False
+            self.units_total = 0
+            self.units_done = 0
+            self.update_progress(message)
+            pm.displayInfo(message)
+
+    def rollback_build(self, spec):
+        # Delete everything the half built rig created
+        delete_handles(spec['created'])
+        spec['created'] = []
+        # Restore attributes we changed on the source joints, a locked channel shouldn't stop the rollback
+        for handle, rotate_order in spec.get('driver_rotate_orders', []):
+            driver = resolve_handle(handle)
+            if driver is None:
+                continue
+            try:
+                driver.rotateOrder.set(rotate_order)
+            except RuntimeError as error:
+                pm.warning("Could not restore rotate order of {}: {}".format(driver.nodeName(), error))
+        pm.displayInfo("Rolled back Arm rig {}".format(spec['arm_name']))
+
+    def update_progress(self, label=None):
+        # The window may have been closed while the queue is still running
+        if self.progress_bar and pm.progressBar(self.progress_bar, exists=True):
+            pm.progressBar(self.progress_bar, edit=True, maxValue=max(self.units_total, 1), progress=self.units_done)
+        if label and self.status_text and pm.text(self.status_text, exists=True):
+            pm.text(self.status_text, edit=True, label=label)
+
+    def build_chain_layout(self, spec):
+        # Chain geometry is always queried fresh, only the roll ordering comes from the previous rig
+        spec.update(compute_chain_layout(spec['arm_joints'], spec['roll_joints'], spec['cached_roll_segments']))
+
+    def build_fk_controls(self, spec):
+        arm_joints = spec['arm_joints']
+        created = spec['created']
+        fk_groups = spec['fk_groups'] = []
+        fk_controls = spec['fk_controls'] = []
+
+        # Params for FK controls
+        col = (0, 0, 1)
+        thick = 2
+        shared = spec['shared_shapes']
 
         # Create FK Controls
-        for j in arm_joints:
+        for j, radius in zip(arm_joints, spec['fk_radii']):
             
             null_group = pm.group(empty=True, n="FK_" + j.nodeName() + "_Offset")
+            created.append(get_handle(null_group))
             fk_groups.append(null_group)
             null_group.setMatrix(j.getMatrix(worldSpace=True), worldSpace=True)
-            
-            # Params for FK controls
-            col = (0, 0, 1)
-            thick = 2
 
             # Parent the null group to previous curve if not first iteration
-            if j != arm_joints[0]:
-                pm.parent(null_group, fk_control)
-            # # Create control shape for FK
-            if j == arm_joints[0]:
-                fk_control = create_custom_circle(radius=14.0, sections=8, color=col, thickness=thick)
-            elif j == arm_joints[1]:
-                fk_control = create_custom_circle(radius=9.0, sections=8, color=col, thickness=thick)
-            elif j == arm_joints[2]:
-                fk_control = create_custom_circle(radius=7.0, sections=8, color=col, thickness=thick)
+            if fk_controls:
+                pm.parent(null_group, fk_controls[-1])
+            # Create control shape for FK, sizes go down the chain
+            fk_control = create_custom_circle(radius=radius, sections=8, color=col, thickness=thick, normal=(1, 0, 0), shared=shared)
+            created.append(get_handle(fk_control))
             
             fk_control.rename("FK_" + j.nodeName() + "_Ctrl")
             fk_controls.append(fk_control)
-            # Pre rotate for correct orientation
-            pm.rotate(fk_control, (0, 90, 0))
-            # Freeze transformations (including rotation)
-            pm.makeIdentity(fk_control, apply=True, rotate=True, normal=False)
+            # Circle already faces down the joint thanks to its normal, shared shapes can't be frozen anyway
             pm.parent(fk_control, null_group)
             # Zero out the rotations and translations
             pm.xform(fk_control, rotation=(0, 0, 0), translation=(0, 0, 0))
 
             # Hide & lock translate and scale attributes
             for attr in ['translateX', 'translateY', 'translateZ', 'scaleX', 'scaleY', 'scaleZ']:
-                pm.setAttr(fk_control + '.' + attr, keyable=False, channelBox=False, lock=True)
+                pm.setAttr(fk_control.attr(attr), keyable=False, channelBox=False, lock=True)
 
-        pm.select(clear=True)
+    def build_ik_chain(self, spec):
+        arm_joints = spec['arm_joints']
+        ik_joints = spec['ik_joints'] = []
 
-        # Create IK joints
+        # Create IK joints, parented explicitly so the selection doesn't matter
         for j in arm_joints:
             # Create a new joint
-            ik_joint = pm.joint(n="IK_" + j.nodeName())
+            if ik_joints:
+                ik_joint = pm.createNode('joint', name="IK_" + j.nodeName(), parent=ik_joints[-1])
+            else:
+                ik_joint = pm.createNode('joint', name="IK_" + j.nodeName())
+            spec['created'].append(get_handle(ik_joint))
             ik_joints.append(ik_joint)
             
             # Apply joint-specific attributes
@@ -167,76 +343,136 @@ class ArmRigUI(object):
             # Apply the world matrix to the new joint
             ik_joint.setMatrix(j.getMatrix(worldSpace=True), worldSpace=True)
 
-        # Create an IK handle using the first and last IK joints
-        ik_handle, effector = pm.ikHandle(startJoint=ik_joints[0], endEffector=ik_joints[-1], solver='ikRPsolver')
-        ik_handle.rename("IK_Handle_" + arm.nodeName())
+        # RP handle over the first two segments only, that is the limb itself (arm -> hand, hip -> ankle)
+        ik_handle, effector = pm.ikHandle(startJoint=ik_joints[0], endEffector=ik_joints[2], solver='ikRPsolver')
+        spec['created'].append(get_handle(ik_handle))
+        ik_handle.rename("IK_Handle_" + arm_joints[0].nodeName())
+        spec['ik_handle'] = ik_handle
+
+        print("IK Handle created from {} to {}".format(ik_joints[0], ik_joints[2]))
 
-        print("IK Handle created from {} to {}".format(ik_joints[0], ik_joints[-1]))
+        # SC handles for every segment past the limb end, ankle -> ball -> toe on a leg
+        spec['sc_handles'] = []
+        for index in range(2, len(ik_joints) - 1):
+            sc_handle, sc_effector = pm.ikHandle(startJoint=ik_joints[index], endEffector=ik_joints[index + 1], solver='ikSCsolver')
+            spec['created'].append(get_handle(sc_handle))
+            sc_handle.rename("IK_Handle_" + arm_joints[index].nodeName())
+            spec['sc_handles'].append(sc_handle)
+
+    def build_pole_vector(self, spec):
+        positions = spec['chain_positions']
+        # Pole sits behind the middle joint of the RP handle, the elbow or the knee
+        forearm = spec['arm_joints'][1]
+        ik_handle = spec['ik_handle']
 
         # Create locator for pole vector
         loc_control = create_custom_locator(name='IK_Pole_' + forearm.nodeName() + '_Ctrl', size=3.0, color=(1, 0, 0))
-        loc_group = create_bisector_group("IK_Pole_" + forearm.nodeName() + "_Offset", arm, forearm, hand)
+        spec['created'].append(get_handle(loc_control))
+        loc_group = create_bisector_group("IK_Pole_" + forearm.nodeName() + "_Offset", positions[0], positions[1], positions[2])
+        spec['created'].append(get_handle(loc_group))
         #shift locator a bit back
-        pm.xform(loc_control, rotation=(0, 0, 0), translation=(0, 0, -calculate_distance(arm, hand)))
+        pm.xform(loc_control, rotation=(0, 0, 0), translation=(0, 0, -spec['limb_length']))
         pm.makeIdentity(loc_control, apply=True, translate=True, normal=False)
         
         # Wierd stuff but it does the trick
         grp = pm.group(em=True, n="Orient_" + forearm.nodeName() + "_Grp")
-        grp.setTranslation(forearm.getTranslation(worldSpace=True), worldSpace=True)
+        grp.setTranslation(positions[1], worldSpace=True)
         pm.parent(grp, loc_group)
         pm.parent(loc_control, grp)
         pm.xform(loc_control, rotation=(0, 0, 0), translation=(0, 0, 0))
 
         # Create the pole vector constraint
-        pm.poleVectorConstraint(loc_control, ik_handle)
+        pole_cs = pm.poleVectorConstraint(loc_control, ik_handle)
+        spec['ik_constraints'] = [pole_cs]
         print("Pole vector constraint added between {} and {}".format(loc_control, ik_handle))
 
+        spec['loc_control'] = loc_control
+        spec['loc_group'] = loc_group
+
+    def build_ik_control(self, spec):
+        # The control drives the limb end, the hand or the ankle, not the tip of the chain
+        hand = spec['arm_joints'][2]
+        ik_joints = spec['ik_joints']
+        ik_handle = spec['ik_handle']
+
         # Create the NURBS cube control
-        handIK_control = create_custom_cube(name="IK_" + hand.nodeName() + "_Ctrl", size=10.0, color=(1, 0.7, 0), thickness=2)
-        handIK_group = pm.group(handIK_control, n="IK_" + j.nodeName() + "_Offset")
+        handIK_control = create_custom_cube(name="IK_" + hand.nodeName() + "_Ctrl", size=10.0, color=(1, 0.7, 0), thickness=2, shared=spec['shared_shapes'])
+        spec['created'].append(get_handle(handIK_control))
+        handIK_group = pm.group(handIK_control, n="IK_" + hand.nodeName() + "_Offset")
+        spec['created'].append(get_handle(handIK_group))
         handIK_group.setMatrix(hand.getMatrix(worldSpace=True), worldSpace=True)
         # Constrain to the IK handle and hand
         pnt_cs_handIK = pm.pointConstraint(handIK_control, ik_handle)
-        pm.orientConstraint(handIK_control, ik_joints[2])
+        orient_cs_handIK = pm.orientConstraint(handIK_control, ik_joints[2])
+        spec['ik_constraints'] += [pnt_cs_handIK, orient_cs_handIK]
+        # Segments past the limb end follow the control through their SC handles
+        if spec['sc_handles']:
+            pm.parent(spec['sc_handles'], handIK_control)
         # Hide & lock translate and rotate attributes
         for attr in ['scaleX', 'scaleY', 'scaleZ']:
-            pm.setAttr(handIK_control + '.' + attr, keyable=False, channelBox=False, lock=True)
+            pm.setAttr(handIK_control.attr(attr), keyable=False, channelBox=False, lock=True)
         # hide ik joints and handle
         for ik_joint in ik_joints:
             ik_joint.v.set(0)
-        ik_handle.v.set(0)
+        for handle in [ik_handle] + spec['sc_handles']:
+            handle.v.set(0)
+
+        spec['handIK_control'] = handIK_control
+        spec['handIK_group'] = handIK_group
+
+    def build_switch(self, spec):
+        arm = spec['arm_joints'][0]
+        positions = spec['chain_positions']
 
         # Create IKFK switch
-        switch_control = create_custom_triangle(name="IKFK_Switch_" + arm.nodeName() + "_Ctrl", size=10.0, color=(0, 1, 0), thickness=2)
+        switch_control = create_custom_triangle(name="IKFK_Switch_" + arm.nodeName() + "_Ctrl", size=10.0, color=(0, 1, 0), thickness=2, shared=spec['shared_shapes'])
+        spec['created'].append(get_handle(switch_control))
         switch_group = pm.group(switch_control, n="IKFK_Switch_"  + arm.nodeName() + "_Offset")
-        # Reposition the switch
-        if is_object_on_positive_x(hand):
-            switch_group.setTranslation(arm.getTranslation(worldSpace=True) + (calculate_distance(arm, hand)/2,0,0), worldSpace=True)
+        spec['created'].append(get_handle(switch_group))
+        # Reposition the switch, outwards from the side the chain ends on
+        if positions[-1].x > 0:
+            switch_group.setTranslation(positions[0] + (spec['limb_length']/2,0,0), worldSpace=True)
         else:
-            switch_group.setTranslation(arm.getTranslation(worldSpace=True) + (-calculate_distance(arm, hand)/2,0,0), worldSpace=True)
+            switch_group.setTranslation(positions[0] + (-spec['limb_length']/2,0,0), worldSpace=True)
 
         # Hide & lock translate, rotate, and scale attributes
         for attr in ['translateX', 'translateY', 'translateZ', 'rotateX', 'rotateY', 'rotateZ', 'scaleX', 'scaleY', 'scaleZ']:
-            pm.setAttr(switch_control + '.' + attr, keyable=False, channelBox=False, lock=True)
+            pm.setAttr(switch_control.attr(attr), keyable=False, channelBox=False, lock=True)
         # Attr for a switch
         pm.addAttr(switch_control, longName= arm.nodeName() + '_IKFK', attributeType='float', keyable=True, defaultValue=1.0, minValue=0.0, maxValue=1.0)
-        switch_attr = switch_control.attr(arm.nodeName() + '_IKFK')
+
+        spec['switch_control'] = switch_control
+        spec['switch_group'] = switch_group
+        spec['switch_attr'] = switch_control.attr(arm.nodeName() + '_IKFK')
+
+    def build_rig_groups(self, spec):
+        arm = spec['arm_joints'][0]
 
         # Create groups for a rig
         rig_group = pm.group(em=True, n=arm.nodeName() + "_Rig")
+        spec['created'].append(get_handle(rig_group))
         ik_group = pm.group(em=True, p=rig_group, n="IK_" + arm.nodeName() + "_Group")
         fk_group = pm.group(em=True, p=rig_group, n="FK_" + arm.nodeName() + "_Group")
         constraints_group = pm.group(em=True, p=rig_group, n="Constraints_" + arm.nodeName() + "_Group")
 
-        pm.parent(ik_joints[0], loc_group, ik_handle, handIK_group, ik_group)
-        pm.parent(fk_groups[0], fk_group)
-        pm.parent(switch_group, rig_group)
+        pm.parent(spec['ik_joints'][0], spec['loc_group'], spec['ik_handle'], spec['handIK_group'], ik_group)
+        pm.parent(spec['fk_groups'][0], fk_group)
+        pm.parent(spec['switch_group'], rig_group)
+
+        spec['rig_group'] = rig_group
+        spec['constraints_group'] = constraints_group
+
+    def build_ikfk_constraints(self, spec):
+        ik_joints = spec['ik_joints']
+        fk_controls = spec['fk_controls']
+        switch_attr = spec['switch_attr']
 
         # Add constraints and driven keys for IKFK
-        for index, j in enumerate(arm_joints):
+        for index, j in enumerate(spec['arm_joints']):
             pnt_cs = pm.parentConstraint(ik_joints[index], j, mo=True)
+            spec['created'].append(get_handle(pnt_cs))
             pnt_cs = pm.parentConstraint(fk_controls[index], j, mo=True)
-            pm.parent(pnt_cs, constraints_group)
+            pm.parent(pnt_cs, spec['constraints_group'])
             # Set Driven Keys to drive the weights between IK and FK
             pm.setDrivenKeyframe(pnt_cs.getWeightAliasList()[0], cd=switch_attr, dv=0, v=0)  # attr 1 IK_weight = 0)
             pm.setDrivenKeyframe(pnt_cs.getWeightAliasList()[1], cd=switch_attr, dv=0, v=1)  # attr 0 FK_weight = 1)
@@ -248,46 +484,101 @@ class ArmRigUI(object):
             pm.setDrivenKeyframe(fk_controls[index].visibility, cd=switch_attr, dv=0, v=1)  # attr 0 FK visible
             pm.setDrivenKeyframe(fk_controls[index].visibility, cd=switch_attr, dv=1, v=0)  # attr 1 FK hidden
             # IK visible
-        pm.setDrivenKeyframe(handIK_control.visibility, cd=switch_attr, dv=1, v=1) # attr 1 IK visible
-        pm.setDrivenKeyframe(handIK_control.visibility, cd=switch_attr, dv=0, v=0) # attr 0 IK hidden
-        pm.setDrivenKeyframe(loc_control.visibility, cd=switch_attr, dv=1, v=1) # attr 1 IK visible
-        pm.setDrivenKeyframe(loc_control.visibility, cd=switch_attr, dv=0, v=0) # attr 0 IK hidden
-
-        if roll_joints:
-            #sort roll joints cuz we don't believe in names
-            sorted_roll_joints = sort_roll_joints_by_distance(roll_joints, forearm)
-            num_of_joints = len(roll_joints)
-            frac = generate_roll_fractions(len(roll_joints), max_value=0.75,min_value= 0.25)[::-1]
-            
-            for i, joint in enumerate(sorted_roll_joints):
+        pm.setDrivenKeyframe(spec['handIK_control'].visibility, cd=switch_attr, dv=1, v=1) # attr 1 IK visible
+        pm.setDrivenKeyframe(spec['handIK_control'].visibility, cd=switch_attr, dv=0, v=0) # attr 0 IK hidden
+        pm.setDrivenKeyframe(spec['loc_control'].visibility, cd=switch_attr, dv=1, v=1) # attr 1 IK visible
+        pm.setDrivenKeyframe(spec['loc_control'].visibility, cd=switch_attr, dv=0, v=0) # attr 0 IK hidden
+
+    def build_roll_joints(self, spec):
+        chain = spec['arm_joints']
+        spec['roll_mults'] = []
+
+        # Drivers and signed multipliers come from compute_chain_layout
+        for driver_index, rolls in spec['roll_segments']:
+            driver = chain[driver_index]
+            for handle, fraction in rolls:
+                joint = resolve_handle(handle)
                 # Create a multiplyDivide node for each roll joint
-                mult_node = pm.createNode('multiplyDivide', name= joint + '_rotationMult')
+                mult_node = pm.createNode('multiplyDivide', name=joint.nodeName() + '_rotationMult')
+                spec['created'].append(get_handle(mult_node))
+                spec['roll_mults'].append(mult_node)
                 # Set the multiply operation
                 mult_node.operation.set(1)  # 1 = Multiply
                 # Set the input2X to the fraction for this roll joint
-                mult_node.input2X.set(frac[i])
-                # Connect the driver control's rotateX to the input1X of the multiplyDivide node
-                pm.connectAttr(hand + '.rotateX', mult_node + '.input1X')
+                mult_node.input2X.set(fraction)
+                # Connect the driver joint's rotateX to the input1X of the multiplyDivide node
+                pm.connectAttr(driver.rotateX, mult_node.input1X)
                 # Connect the outputX of the multiplyDivide node to the joint's rotateX
-                pm.connectAttr(mult_node + '.outputX', joint + '.rotateX')
+                pm.connectAttr(mult_node.outputX, joint.rotateX)
         
-        # fix rotation order of hand
-        hand.rotateOrder.set(5)
+        # fix rotation order of the twist drivers, the hand (limb end) and whatever drives the segments past it.
+        # The root counter rotates its own rolls and keeps its rotate order, like the arm always did
+        driver_indices = sorted(set([2] + [driver_index for driver_index, rolls in spec['roll_segments'] if driver_index > 0]))
+        spec['driver_rotate_orders'] = []
+        for driver_index in driver_indices:
+            driver = chain[driver_index]
+            spec['driver_rotate_orders'].append((spec['arm_handles'][driver_index], driver.rotateOrder.get()))
+            driver.rotateOrder.set(5)
 
-        pm.displayInfo("Arm rig was built successfully.")
+    def build_eval_lod(self, spec):
+        arm = spec['arm_joints'][0]
+        switch_control = spec['switch_control']
+        switch_attr = spec['switch_attr']
+
+        # LOD for background characters, Low skips roll twist and the IK solve
+        pm.addAttr(switch_control, longName='evalLOD', attributeType='enum', enumName='Full:Low', keyable=True)
+
+        # nodeState values: 0 = Normal, 2 = Blocking
+        lod_state = pm.createNode('condition', name=arm.nodeName() + '_LOD_State')
+        spec['created'].append(get_handle(lod_state))
+        lod_state.operation.set(0)  # 0 = Equal
+        pm.connectAttr(switch_control.evalLOD, lod_state.firstTerm)
+        lod_state.secondTerm.set(0)
+        lod_state.colorIfTrueR.set(0)  # Full evaluates
+        lod_state.colorIfFalseR.set(2)  # Low blocks
+
+        # IK branch is blocked at full FK, its weight is 0 there so the pose does not change
+        ik_state = pm.createNode('condition', name=arm.nodeName() + '_IK_State')
+        spec['created'].append(get_handle(ik_state))
+        ik_state.operation.set(0)  # 0 = Equal
+        pm.connectAttr(switch_attr, ik_state.firstTerm)
+        ik_state.secondTerm.set(0)
+        ik_state.colorIfTrueR.set(2)
+        # Anywhere else the IK branch follows the LOD
+        pm.connectAttr(lod_state.outColorR, ik_state.colorIfFalseR)
+
+        # FK controls are frozen at full IK, same reasoning as above
+        fk_state = pm.createNode('condition', name=arm.nodeName() + '_FK_State')
+        spec['created'].append(get_handle(fk_state))
+        fk_state.operation.set(0)  # 0 = Equal
+        pm.connectAttr(switch_attr, fk_state.firstTerm)
+        fk_state.secondTerm.set(1)
+        fk_state.colorIfTrueR.set(1)
+        fk_state.colorIfFalseR.set(0)
+
+        for node in [spec['ik_handle']] + spec['sc_handles'] + spec['ik_constraints']:
+            pm.connectAttr(ik_state.outColorR, node.nodeState)
+        # Transforms ignore nodeState, frozen is what the evaluation manager skips for them
+        enable_frozen_evaluator()
+        for fk_control in spec['fk_controls']:
+            pm.connectAttr(fk_state.outColorR, fk_control.frozen)
+        for mult_node in spec['roll_mults']:
+            pm.connectAttr(lod_state.outColorR, mult_node.nodeState)
+
+    def register_rig(self, spec):
+        # Tag the arm with the rig and the rig with everything it owns, so lookups and deletes are by handle
+        tag_rig(spec['arm_joints'][0], spec['rig_group'], spec['created'])
+        store_rig_rolls(spec['rig_group'], spec['arm_handles'], spec['roll_handles'], spec['roll_segments'])
 
 
     def delete_arm_rig(self):
         # Delete existing rig
-        arm_joints = self.arm_joints
-        roll_joints = self.roll_joints
+        arm = resolve_handle(self.arm_joints[0]) if self.arm_joints else None
         
-        if arm_joints:
-            if pm.ls(arm_joints[0].nodeName() + "_Rig", type='transform'):
-                if roll_joints:
-                    for joint in roll_joints:
-                        delete_nodes_containing(joint.nodeName(),'multiplyDivide')
-                delete_nodes_containing(arm_joints[0].nodeName() + "_Rig", 'transform')
+        if arm is not None:
+            # Joints deleted since they were picked can't drive anything anymore, skip them
+            chain = [joint for joint in (resolve_handle(handle) for handle in self.arm_joints) if joint is not None]
+            if delete_rig(arm, chain):
                 # except solvers actually but they can be shared among other rigs in the scene so leave them be
                 pm.displayInfo("Arm Rig was deleted")
             else:
@@ -317,22 +608,8 @@ armrigtool = ArmRigUI()
 armrigtool.create_ui()
 
 
-def is_object_on_positive_x(obj):
-    # Get the world space position of the object
-    position = pm.xform(obj, q=True, ws=True, t=True)
-    
-    # Check the X component of the position
-    if position and len(position) == 3:  # Ensure the position is valid
-        return position[0] > 0  # Return True if on positive X, False otherwise
-    else:
-        pm.warning("Invalid object position or object does not exist.")
-        return None  # Return None if the position is invalid
-
-def create_bisector_group(name, joint1, joint2, joint3):
-    # Get the positions of the joints
-    pos1 = pm.datatypes.Vector(pm.xform(joint1, query=True, worldSpace=True, translation=True))
-    pos2 = pm.datatypes.Vector(pm.xform(joint2, query=True, worldSpace=True, translation=True))
-    pos3 = pm.datatypes.Vector(pm.xform(joint3, query=True, worldSpace=True, translation=True))
+def create_bisector_group(name, pos1, pos2, pos3):
+    # Positions of the first, middle and last joint, already fetched by the caller
 
     # Calculate vectors
     vec1 = pos1 - pos2
@@ -387,9 +664,12 @@ def create_custom_locator(name, size=3.0, color=(1, 0, 0)):
     loc_shape.localScale.set([size, size, size])
     
     return loc_control
-def create_custom_circle(radius=14.0, sections=8, color=(1, 0, 0), thickness=2):
+def create_custom_circle(radius=14.0, sections=8, color=(1, 0, 0), thickness=2, normal=(0, 0, 1), shared=False):
+    if shared:
+        key = 'circle_{}_{}_{}_{}'.format(radius, sections, thickness, normal)
+        return create_shared_control(key, None, color, lambda shape_name: pm.circle(n=shape_name, radius=radius, sections=sections, normal=normal)[0], thickness)
     # Create the circle curve
-    circle_curve = pm.circle(radius=radius, sections=sections)[0]
+    circle_curve = pm.circle(radius=radius, sections=sections, normal=normal)[0]
     # Get the shape node of the curve
     circle_shape = circle_curve.getShape()
     # Set the color
@@ -401,7 +681,7 @@ def create_custom_circle(radius=14.0, sections=8, color=(1, 0, 0), thickness=2):
     
     return circle_curve
 
-def create_custom_cube(name, size=10.0, color=(1, 1, 0), thickness=2):
+def cube_curve(name, size):
     # Create the NURBS cube
     nurbs_cube = pm.curve(n = name, d=1, p=[(-0.5, 0.5, 0.5), (-0.5, 0.5, -0.5), (0.5, 0.5, -0.5), (0.5, 0.5, 0.5), (-0.5, 0.5, 0.5), (-0.5, -0.5, 0.5), (-0.5, -0.5, -0.5), (0.5, -0.5, -0.5), (0.5, -0.5, 0.5), (-0.5, -0.5, 0.5), (-0.5, 0.5, 0.5), (0.5, 0.5, 0.5), (0.5, -0.5, 0.5), (0.5, -0.5, -0.5), (0.5, 0.5, -0.5), (-0.5, 0.5, -0.5), (-0.5, -0.5, -0.5)], k=[0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16])
 
@@ -409,6 +689,13 @@ def create_custom_cube(name, size=10.0, color=(1, 1, 0), thickness=2):
     pm.scale(nurbs_cube, [size, size, size])
     # Freeze transformations to apply the scale
     pm.makeIdentity(nurbs_cube, apply=True, t=1, r=1, s=1, n=0)
+    return nurbs_cube
+
+def create_custom_cube(name, size=10.0, color=(1, 1, 0), thickness=2, shared=False):
+    if shared:
+        key = 'cube_{}_{}'.format(size, thickness)
+        return create_shared_control(key, name, color, lambda shape_name: cube_curve(shape_name, size), thickness)
+    nurbs_cube = cube_curve(name, size)
     # Set the color
     shape = nurbs_cube.getShape()
     shape.overrideEnabled.set(1)
@@ -421,7 +708,7 @@ def create_custom_cube(name, size=10.0, color=(1, 1, 0), thickness=2):
     
     return nurbs_cube
 
-def create_custom_triangle(name, size=10.0, color=(0, 1, 0), thickness=2):
+def triangle_curve(name, size):
     # Create the NURBS triangle curve with the peak at the top (+Y axis) and facing the Z-axis
     nurbs_triangle = pm.curve(n=name, d=1, 
                               p=[(0, 0, -0.577), (0.5, 0, 0.289), (-0.5, 0, 0.289), (0, 0, -0.577)],
@@ -432,6 +719,13 @@ def create_custom_triangle(name, size=10.0, color=(0, 1, 0), thickness=2):
     pm.scale(nurbs_triangle, [size, size, size])
     # Freeze transformations to apply the scale and rotation
     pm.makeIdentity(nurbs_triangle, apply=True, t=1, r=1, s=1, n=0)
+    return nurbs_triangle
+
+def create_custom_triangle(name, size=10.0, color=(0, 1, 0), thickness=2, shared=False):
+    if shared:
+        key = 'triangle_{}_{}'.format(size, thickness)
+        return create_shared_control(key, name, color, lambda shape_name: triangle_curve(shape_name, size), thickness)
+    nurbs_triangle = triangle_curve(name, size)
     # Set the color
     shape = nurbs_triangle.getShape()
     shape.overrideEnabled.set(1)
@@ -443,34 +737,337 @@ def create_custom_triangle(name, size=10.0, color=(0, 1, 0), thickness=2):
     pm.xform(nurbs_triangle, centerPivots=True)
     return nurbs_triangle
 
-def calculate_distance(obj1, obj2):
-    """Calculate the distance between two objects in world space."""
-    pos1 = pm.xform(obj1, q=True, ws=True, t=True)
-    pos2 = pm.xform(obj2, q=True, ws=True, t=True)
-    return ((pos1[0] - pos2[0])**2 + 
-            (pos1[1] - pos2[1])**2 + 
-            (pos1[2] - pos2[2])**2) ** 0.5
+# Shared control shapes, one template curve per style and size lives in a hidden library group
+shared_shape_cache = {}
 
-def sort_roll_joints_by_distance(roll_joints, forearm_joint):
-    return sorted(roll_joints, key=lambda joint: calculate_distance(joint, forearm_joint))
+def get_shape_library():
+    # Hidden group holding the template curves, found by tag so renaming it does no harm
+    library = resolve_handle(shared_shape_cache['library']) if 'library' in shared_shape_cache else None
+    if library is None:
+        libraries = [node for node in pm.ls('*.armRigShapeLibrary', objectsOnly=True, recursive=True) if not node.isReferenced()]
+        if libraries:
+            library = libraries[0]
+        else:
+            library = pm.group(empty=True, world=True, n="ArmRig_Shared_Shapes")
+            pm.addAttr(library, longName='armRigShapeLibrary', attributeType='bool')
+            library.visibility.set(0)
+        shared_shape_cache['library'] = get_handle(library)
+    return library
 
-def generate_roll_fractions(num_joints, max_value=0.75, min_value=0.15):
-    if num_joints == 1:
-        fractions = [0.5]
-    else:
-        step = (max_value - min_value) / (num_joints - 1)
-        fractions = [max_value - i * step for i in range(num_joints)]
-    return fractions
-
-def delete_nodes_containing(substring, node_type=None):
-    # Find all nodes of the specified type, or all nodes if no type is provided
-    if node_type:
-        nodes = pm.ls(type=node_type)
+def get_shared_shape(key, create_template, thickness):
+    template = resolve_handle(shared_shape_cache[key]) if key in shared_shape_cache else None
+    if template is None:
+        library = get_shape_library()
+        # Reuse a template saved with the scene before creating a new one
+        templates = [node for node in library.getChildren() if node.hasAttr('armRigShapeKey') and node.armRigShapeKey.get() == key]
+        if templates:
+            template = templates[0]
+        else:
+            # Keys hold sizes like 14.0, swap anything Maya won't take in a name
+            template = create_template(''.join(c if c.isalnum() else '_' for c in key) + "_Shape")
+            pm.addAttr(template, longName='armRigShapeKey', dataType='string')
+            template.armRigShapeKey.set(key)
+            # Color comes from the control transform, the shape only keeps the thickness
+            template.getShape().lineWidth.set(thickness)
+            pm.parent(template, library)
+        shared_shape_cache[key] = get_handle(template)
+    return template.getShape()
+
+def create_shared_control(key, name, color, create_template, thickness):
+    # Empty transform with the shared shape instanced under it
+    shape = get_shared_shape(key, create_template, thickness)
+    control = pm.group(empty=True, world=True, n=name or "sharedCtrl")
+    pm.parent(shape, control, shape=True, addObject=True)
+    # Per rig color goes on the transform, the shape inherits it since its own override is off
+    control.overrideEnabled.set(1)
+    control.overrideRGBColors.set(1)
+    control.overrideColorRGB.set(color)
+    return control
+
+def measure_shared_shapes(count=100):
+    # Compare per rig shapes against shared ones, better run it in an empty scene
+    libraries_before = pm.ls('*.armRigShapeLibrary', objectsOnly=True, recursive=True)
+    templates_before = [template for library in libraries_before for template in library.getChildren()]
+    results = {}
+    for shared in (False, True):
+        controls = []
+        for i in range(count):
+            controls.append(create_custom_circle(radius=14.0, sections=8, color=(0, 0, 1), normal=(1, 0, 0), shared=shared))
+            controls.append(create_custom_cube(name="Bench_Cube", size=10.0, color=(1, 0.7, 0), shared=shared))
+            controls.append(create_custom_triangle(name="Bench_Triangle", size=10.0, color=(0, 1, 0), shared=shared))
+        mode = 'shared' if shared else 'per_rig'
+        path = os.path.join(tempfile.gettempdir(), "armRig_shapes_{}.ma".format(mode))
+        pm.select(controls)
+        pm.exportSelected(path, type='mayaAscii', force=True)
+        pm.delete(controls)
+
+        # Load it back in its own namespace and throw it away
+        start = time.time()
+        pm.importFile(path, namespace="armRigBench")
+        load_time = time.time() - start
+        pm.namespace(removeNamespace="armRigBench", deleteNamespaceContent=True)
+
+        results[mode] = (os.path.getsize(path), load_time)
+        pm.displayInfo("{} controls, {}: {} bytes, loaded in {:.3f}s".format(count * 3, mode, results[mode][0], load_time))
+
+    # Leave the scene as it was, drop the library and templates only the shared pass made
+    for library in pm.ls('*.armRigShapeLibrary', objectsOnly=True, recursive=True):
+        if library not in libraries_before:
+            pm.delete(library)
+        else:
+            # delete with an empty list would take the selection instead
+            added = [template for template in library.getChildren() if template not in templates_before]
+            if added:
+                pm.delete(added)
+    for key in list(shared_shape_cache):
+        if resolve_handle(shared_shape_cache[key]) is None:
+            del shared_shape_cache[key]
+    return results
+
+def enable_frozen_evaluator():
+    # Maya ships with the frozen evaluator off, without it the frozen flag does nothing
+    if 'frozen' not in (pm.evaluator(query=True) or []):
+        pm.warning("No frozen evaluator in this Maya, FK controls will keep evaluating at full IK")
+        return False
+    if not pm.evaluator(name='frozen', query=True, enable=True):
+        pm.evaluator(name='frozen', enable=True)
+        pm.displayInfo("Enabled the frozen evaluator for this session, Arm Rig LOD needs it")
+
+    # Evaluator settings are the artist's, leave them alone unless they would break the rig.
+    # Forced downstream propagation freezes the arm joints the FK controls constrain
+    entries = pm.evaluator(name='frozen', query=True, configuration=True) or []
+    configuration = dict(entry.split('=', 1) for entry in entries if '=' in entry)
+    if configuration.get('downstream') == 'force':
+        pm.warning("Frozen evaluator propagates downstream by force, which would freeze the arm joints, switching it to safe")
+        pm.evaluator(name='frozen', configuration='downstream=safe')
+    return True
+
+def time_playback(start, end):
+    # Step through the range the way playback does and time it
+    begin = time.time()
+    for frame in range(int(start), int(end) + 1):
+        pm.currentTime(frame, update=True)
+    return time.time() - begin
+
+def measure_playback(start=None, end=None):
+    # Playback time of every rig in the scene blended, at its IK endpoint and at Low LOD, run it on an animated scene
+    start = pm.playbackOptions(query=True, minTime=True) if start is None else start
+    end = pm.playbackOptions(query=True, maxTime=True) if end is None else end
+    switches = pm.ls('*.evalLOD', objectsOnly=True, recursive=True)
+    switch_attrs = [attr for switch in switches for attr in switch.listAttr(userDefined=True) if attr.attrName().endswith('_IKFK')]
+    lod_attrs = [switch.evalLOD for switch in switches]
+
+    # Keyed or locked channels can't be overridden, leave those rigs as they are
+    switch_attrs = [attr for attr in switch_attrs if attr.isSettable()]
+    lod_attrs = [attr for attr in lod_attrs if attr.isSettable()]
+    saved = [(attr, attr.get()) for attr in switch_attrs + lod_attrs]
+
+    # Blended keeps both branches live, the cost every rig paid before the endpoint freeze
+    modes = [('blended', 0.5, 0), ('ik_endpoint', 1.0, 0), ('low_lod', 1.0, 1)]
+    results = {}
+    try:
+        for mode, blend, lod in modes:
+            for attr in switch_attrs:
+                attr.set(blend)
+            for attr in lod_attrs:
+                attr.set(lod)
+            results[mode] = time_playback(start, end)
+            pm.displayInfo("{} rigs, {}: {:.3f}s for frames {}-{}".format(len(switches), mode, results[mode], start, end))
+    finally:
+        for attr, value in saved:
+            attr.set(value)
+    return results
+
+def restore_selection(names):
+    # Reselect whatever still exists, ls quietly skips nodes deleted in the meantime
+    nodes = pm.ls(names)
+    if nodes:
+        pm.select(nodes, replace=True)
     else:
-        nodes = pm.ls()
+        pm.select(clear=True)
+
+def get_world_positions(nodes):
+    """World space positions of all nodes from a single xform query."""
+    flat = pm.xform(nodes, q=True, ws=True, t=True)
+    return [pm.datatypes.Vector(flat[i:i + 3]) for i in range(0, len(flat), 3)]
+
+def find_chain_index(joint, chain):
+    # Index of the closest chain joint above this one, None if it does not hang off the chain
+    parent = joint.getParent()
+    while parent is not None:
+        if parent in chain:
+            return chain.index(parent)
+        parent = parent.getParent()
+    return None
+
+def generate_control_radii(num_joints, radii=(14.0, 9.0, 7.0)):
+    # Spread the arm sizes along a chain of any length, 3 joints get exactly 14, 9, 7
+    result = []
+    for i in range(num_joints):
+        t = float(i) / (num_joints - 1) * (len(radii) - 1)
+        k = min(int(t), len(radii) - 2)
+        result.append(radii[k] + (radii[k + 1] - radii[k]) * (t - k))
+    return result
+
+def order_roll_joints_along_axis(roll_joints, positions, start, end):
+    """Order roll joints by their projection on the start -> end axis, fraction is that parameter."""
+    axis = end - start
+    length_sq = axis.dot(axis)
+    if length_sq == 0:
+        # Both ends on the same spot give no axis to project on, spread the rolls evenly instead
+        pm.warning("Roll segment has zero length, spreading {} roll joints evenly".format(len(roll_joints)))
+        return [(joint, float(i + 1) / (len(roll_joints) + 1)) for i, joint in enumerate(roll_joints)]
+    params = []
+    for joint, position in zip(roll_joints, positions):
+        # Offsets from the bone don't matter, only how far along it the joint sits
+        t = (position - start).dot(axis) / length_sq
+        params.append((joint, min(max(t, 0.0), 1.0)))
+    return sorted(params, key=lambda item: item[1])
+
+def compute_chain_layout(chain, roll_joints, roll_segments=None):
+    # One geometry query for the chain and all roll joints, every build stage works off this.
+    # Roll ordering stored on a previous rig skips the roll joints in that query
+    if roll_segments is not None:
+        roll_joints = []
+    positions = get_world_positions(chain + roll_joints)
+    chain_positions = positions[:len(chain)]
+    layout = {
+        'chain_positions': chain_positions,
+        # Root to limb end, the span of the RP handle
+        'limb_length': (chain_positions[2] - chain_positions[0]).length(),
+        'fk_radii': generate_control_radii(len(chain)),
+        'roll_segments': roll_segments,
+    }
+    if roll_segments is not None:
+        return layout
+
+    # Group roll joints by the chain joint they hang off
+    last_segment = len(chain) - 2
+    segments = {}
+    for joint, position in zip(roll_joints, positions[len(chain):]):
+        index = find_chain_index(joint, chain)
+        if index is None or index > last_segment:
+            # Separate twist hierarchies go on the last segment, like every roll joint used to
+            index = last_segment
+        segments.setdefault(index, ([], []))
+        segments[index][0].append(joint)
+        segments[index][1].append(position)
+
+    # Which channel twists a segment:
+    # - root segment (upper arm, thigh): the rolls already inherit the root's own twist,
+    #   so they counter rotate its rotateX by (1 - t) to fade it in along the bone
+    # - every other segment (forearm, shin, foot): the joint at its end, the hand twisting the forearm
+    roll_segments = []
+    for index in sorted(segments):
+        joints, joint_positions = segments[index]
+        ordered = order_roll_joints_along_axis(joints, joint_positions, chain_positions[index], chain_positions[index + 1])
+        if index == 0:
+            roll_segments.append((0, [(get_handle(joint), fraction - 1.0) for joint, fraction in ordered]))
+        else:
+            roll_segments.append((index + 1, [(get_handle(joint), fraction) for joint, fraction in ordered]))
+
+    layout['roll_segments'] = roll_segments
+    return layout
+
+# Nodes are tracked by handle and resolved through this cache, so names never matter.
+# A handle is the node UUID, plus the UUIDs of the reference nodes it comes through,
+# since referencing the same file twice gives both copies the same node UUIDs
+node_cache = {}
+
+def reference_path(node):
+    # UUIDs of the reference nodes a node comes through, innermost first, empty for local nodes
+    if not pm.referenceQuery(node, isNodeReferenced=True):
+        return ''
+    path = []
+    ref_node = pm.referenceQuery(node, referenceNode=True)
+    while ref_node:
+        path.append(pm.ls(ref_node, uuid=True)[0])
+        ref_node = pm.referenceQuery(ref_node, referenceNode=True, parent=True)
+    return ','.join(path)
+
+def get_handle(node):
+    handle = pm.ls(node, uuid=True)[0]
+    path = reference_path(node)
+    if path:
+        handle += '/' + path
+    node_cache[handle] = pm.PyNode(node)
+    return handle
+
+def resolve_handle(handle):
+    # A cached PyNode holds an MObjectHandle, it stays valid through renames, reparenting and namespaces
+    node = node_cache.get(handle)
+    if node is not None and node.exists():
+        return node
+    # Cache miss or stale handle after a file reload, ask Maya once and keep the copy from the right reference
+    uuid, _, path = handle.partition('/')
+    nodes = [node for node in pm.ls(uuid) if reference_path(node) == path]
+    if not nodes:
+        node_cache.pop(handle, None)
+        return None
+    node_cache[handle] = nodes[0]
+    return nodes[0]
 
-    # Iterate through the nodes and delete those that contain the substring
-    for node in nodes:
-        # Use the string name of the node for the substring check
-        if substring in str(node.name()):
+def resolve_handles(handles):
+    # Resolve a list of handles, None if any of them is gone
+    nodes = [resolve_handle(handle) for handle in handles]
+    if any(node is None for node in nodes):
+        return None
+    return nodes
+
+def delete_handles(handles):
+    # Parents go first and take their children with them, so resolve each one right before deleting
+    for handle in handles:
+        node = resolve_handle(handle)
+        if node is None:
+            continue
+        # Locked or referenced nodes can't go, delete the rest anyway
+        try:
             pm.delete(node)
+        except RuntimeError as error:
+            pm.warning("Could not delete {}: {}".format(node.nodeName(), error))
+
+def tag_rig(joint, rig_group, handles):
+    if not joint.hasAttr('armRig'):
+        pm.addAttr(joint, longName='armRig', dataType='string')
+    joint.armRig.set(get_handle(rig_group))
+    pm.addAttr(rig_group, longName='armRigNodes', dataType='string')
+    rig_group.armRigNodes.set(' '.join(handles))
+
+def store_rig_rolls(rig_group, chain_handles, roll_handles, roll_segments):
+    # Roll ordering lives on the rig next to armRigNodes, with the joints it was computed for
+    pm.addAttr(rig_group, longName='armRigRolls', dataType='string')
+    rig_group.armRigRolls.set(json.dumps({'chain': chain_handles, 'rolls': roll_handles, 'segments': roll_segments}))
+
+def read_rig_rolls(joint, chain_handles, roll_handles):
+    # Roll ordering of the existing rig, None if there is none or it was built from other joints
+    rig_group = find_rig(joint)
+    if rig_group is None or not rig_group.hasAttr('armRigRolls'):
+        return None
+    stored = json.loads(rig_group.armRigRolls.get() or 'null')
+    if not stored or stored['chain'] != list(chain_handles) or stored['rolls'] != list(roll_handles):
+        return None
+    return [(driver, [tuple(roll) for roll in rolls]) for driver, rolls in stored['segments']]
+
+def find_rig(joint):
+    # Rig group of the arm or None, read straight from the tag instead of searching by name
+    if joint.hasAttr('armRig') and joint.armRig.get():
+        return resolve_handle(joint.armRig.get())
+    # Rigs built before the tag existed are only known by their name
+    legacy = [group for group in pm.ls(joint.nodeName() + "_Rig", type='transform') if not group.hasAttr('armRigNodes')]
+    return legacy[0] if legacy else None
+
+def delete_rig(joint, chain):
+    rig_group = find_rig(joint)
+    if rig_group is None:
+        return False
+    if not rig_group.hasAttr('armRigNodes'):
+        # Older rigs don't list their nodes, their roll multiplies hang off the chain's rotateX
+        pm.warning("{} was built by an older Arm Rig tool, deleting it by name".format(rig_group.nodeName()))
+        mult_nodes = [node for driver in chain for node in driver.rotateX.outputs(type='multiplyDivide')
+                      if node.nodeName().endswith('_rotationMult')]
+        delete_handles([get_handle(node) for node in mult_nodes + [rig_group]])
+        return True
+    # The stored roll ordering goes with the rig group, nothing of it outlives the rig
+    delete_handles(rig_group.armRigNodes.get().split())
+    joint.armRig.set('')
+    return True